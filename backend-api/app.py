@@ -3,7 +3,7 @@ import os
 from datetime import datetime
 from fastapi import FastAPI, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from mongo import database_manager as db
 from mongo import stats_manager
 from recommendation_engine import get_recommendations, get_cold_start_recommendations
@@ -15,7 +15,7 @@ from routers.internal_catalog import router as internal_catalog_router
 setup_logging()
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Tesco Price Tracker API", version="2.0", default_response_class=JSONResponse)
+app = FastAPI(title="Tesco Price Tracker API", version="2.0", default_response_class=ORJSONResponse)
 app.include_router(internal_catalog_router)
 
 # Bind correlation IDs early so every later middleware/handler logs with them.
@@ -133,10 +133,12 @@ def get_product_trend(tpnc: str):
 
     Returns {tpnc, name, history: [{date, normal, discount, clubcard}]}
     """
-    prod = db.get_product(tpnc)
+    prod = db.get_product(tpnc, projection={"name": 1, "price_history": 1})
     if not prod:
         raise HTTPException(status_code=404, detail="Product not found")
-    history = list(reversed(prod.get("price_history", [])))
+    history = prod.get("price_history") or []
+    # Legacy dict-shaped histories have no usable entries
+    history = history[::-1] if isinstance(history, list) else []
     return {
         "tpnc":    tpnc,
         "name":    prod.get("name"),
@@ -147,14 +149,14 @@ def get_product_trend(tpnc: str):
 @app.get("/api/v1/products/{tpnc}/history")
 def get_product_history(tpnc: str):
     """Return price history as {tpnc, points:[{timestamp, price}]} for charting."""
-    if not db.product_exists(tpnc):
+    raw = db.get_price_history_chrono(tpnc)  # oldest → newest
+    if raw is None:
         raise HTTPException(status_code=404, detail="Product not found")
-    raw = list(reversed(db.get_price_history(tpnc)))  # oldest → newest
-    points = []
-    for entry in raw:
-        normal = entry.get("normal")
-        if normal and normal.get("price") is not None:
-            points.append({"timestamp": entry.get("date", ""), "price": normal["price"]})
+    points = [
+        {"timestamp": entry.get("date", ""), "price": normal["price"]}
+        for entry in raw
+        if (normal := entry.get("normal")) and normal.get("price") is not None
+    ]
     return {"tpnc": tpnc, "points": points}
 
 
@@ -201,10 +203,17 @@ def _daily_to_channel_history(history_list: list) -> dict:
     return channels
 
 
+# Fields read by get_product below; skips decoding the bulky nutrition/marketing metadata.
+_EXTENSION_PROJECTION = {
+    "tpnc": 1, "name": 1, "unit_of_measure": 1, "default_image_url": 1,
+    "pack_size_value": 1, "pack_size_unit": 1, "price_history": 1,
+}
+
+
 @app.get("/api/v1/products/{tpnc}")
 def get_product(tpnc: str):
     """Return lightweight product document for the browser extension."""
-    prod = db.get_product(tpnc)
+    prod = db.get_product(tpnc, projection=_EXTENSION_PROJECTION)
     if not prod:
         raise HTTPException(status_code=404, detail="Product not found")
     
@@ -33,7 +33,10 @@ MONGO_COLLECTION = os.getenv('MONGO_COLLECTION', 'products')
 # ---------------------------------------------------------------------------
 # Scraper / threading defaults
 # ---------------------------------------------------------------------------
-DEFAULT_THREADS = 2
+# Worker threads for the scraper; each one has a single API request in flight.
+DEFAULT_THREADS = int(os.getenv('SCRAPER_THREADS', '2'))
+# Products requested per GraphQL POST (the API accepts a list of operations).
+API_BATCH_SIZE = 10
 
 # ---------------------------------------------------------------------------
 # Scheduler settings
@@ -1,7 +1,9 @@
 from datetime import datetime
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from pymongo import errors as mongo_errors
 import logging
+import threading
+import time
 
 from config import MONGO_URI, MONGO_DB_NAME, MONGO_COLLECTION
 
@@ -11,13 +13,21 @@ logger = logging.getLogger(__name__)
 _client = None
 _db = None
 _collection = None
+_client_lock = threading.Lock()
 
 def get_db():
+    """Return the products collection, creating the process-wide MongoClient on first use.
+
+    The client is shared by all threads (it keeps its own connection pool); the
+    lock stops concurrent first calls from each opening a separate client.
+    """
     global _client, _db, _collection
-    if _client is None:
-        _client = MongoClient(MONGO_URI)
-        _db = _client[MONGO_DB_NAME]
-        _collection = _db[MONGO_COLLECTION]
+    if _collection is None:
+        with _client_lock:
+            if _collection is None:
+                _client = MongoClient(MONGO_URI)
+                _db = _client[MONGO_DB_NAME]
+                _collection = _db[MONGO_COLLECTION]
     return _collection
 
 def get_runs_collection():
@@ -38,10 +48,10 @@ def init_db():
     _db['runs'].create_index("_id")
     print("MongoDB indexes verified/created.")
 
-def load_product_data(tpnc):
+def load_product_data(tpnc, projection=None):
     try:
         coll = get_db()
-        return coll.find_one({"_id": str(tpnc)})
+        return coll.find_one({"_id": str(tpnc)}, projection)
     except mongo_errors.PyMongoError as e:
         logger.error(f"Error loading product {tpnc}: {e}")
         return None
@@ -59,10 +69,67 @@ def product_exists(tpnc):
     return coll.count_documents({"_id": str(tpnc)}, limit=1) > 0
 
 
+def bulk_fetch_scrape_state(tpncs, chunk_size=1000):
+    """Return {tpnc: last_scraped_price} for the given TPNCs that exist in the DB.
+
+    Queries in chunks of *chunk_size* IDs, projecting only last_scraped_price,
+    so the scraper can decide staleness without a round trip per product.
+    """
+    coll = get_db()
+    tpncs = [str(t) for t in tpncs]
+    state = {}
+    for start in range(0, len(tpncs), chunk_size):
+        cursor = coll.find(
+            {"_id": {"$in": tpncs[start:start + chunk_size]}},
+            {"last_scraped_price": 1},
+        )
+        for doc in cursor:
+            state[str(doc["_id"])] = doc.get("last_scraped_price")
+    return state
+
+
 # ---------------------------------------------------------------------------
 # Daily price insertion logic
 # ---------------------------------------------------------------------------
 
+def _daily_prices_pipeline(tpnc, price_updates, metadata, now):
+    """Build the update pipeline that records *price_updates* as today's snapshot.
+
+    Today's history entry is merged in place if it exists, otherwise appended,
+    so the stored history is never read back or re-sent.
+    """
+    today_str = now.strftime("%Y-%m-%d")
+
+    static_fields = dict(metadata) if metadata else {}
+    static_fields["last_scraped_price"] = now.isoformat()
+
+    today_fields = {category: dict(fields) for category, fields in price_updates}
+    new_entry = {"date": today_str, "normal": None, "discount": None, "clubcard": None, **today_fields}
+    # Legacy documents may still hold a dict-shaped history; treat anything
+    # that isn't an array as empty (as the old read-modify-write did).
+    is_list = {"$isArray": "$price_history"}
+    history = {"$cond": [is_list, "$price_history", []]}
+
+    # $literal keeps scraped strings starting with "$" from being read as field paths
+    return [{"$set": {
+        **{key: {"$literal": value} for key, value in static_fields.items()},
+        "tpnc": {"$ifNull": ["$tpnc", tpnc]},
+        "price_history": {"$cond": [
+            {"$in": [today_str, {"$cond": [is_list, "$price_history.date", []]}]},
+            {"$map": {
+                "input": history,
+                "as": "entry",
+                "in": {"$cond": [
+                    {"$eq": ["$$entry.date", today_str]},
+                    {"$mergeObjects": ["$$entry", {"$literal": today_fields}]},
+                    "$$entry",
+                ]},
+            }},
+            {"$concatArrays": [history, [{"$literal": new_entry}]]},
+        ]},
+    }}]
+
+
 def insert_daily_prices(tpnc, price_updates, metadata=None):
     """Store prices for today as a daily snapshot.
 
@@ -78,59 +145,110 @@ def insert_daily_prices(tpnc, price_updates, metadata=None):
     Returns
     -------
     dict: {category: bool} — True if a new day entry was created, False if updated.
-    """
-    data = load_product_data(tpnc)
-    if not data:
-        data = {"tpnc": str(tpnc), "price_history": []}
 
-    history = data.setdefault("price_history", [])
-    if isinstance(history, dict):
-        history = []
-        data["price_history"] = history
-
-    today_str = datetime.now().strftime("%Y-%m-%d")
+    The update runs as a single server-side pipeline: today's entry is merged
+    in place if it exists, otherwise appended. The stored history is never
+    read back or re-sent, so one round trip is made regardless of history size.
+    """
+    coll = get_db()
+    tpnc = str(tpnc)
+    now = datetime.now()
+    today_str = now.strftime("%Y-%m-%d")
+    pipeline = _daily_prices_pipeline(tpnc, price_updates, metadata, now)
 
-    # Find today's entry or create a blank one
-    today_entry = None
-    for entry in history:
-        if isinstance(entry, dict) and entry.get("date") == today_str:
-            today_entry = entry
-            break
+    try:
+        before = coll.find_one_and_update(
+            {"_id": tpnc},
+            pipeline,
+            projection={"price_history": {"$elemMatch": {"date": today_str}}},
+            upsert=True,
+        )
+        is_new_day = not (before and before.get("price_history"))
+    except mongo_errors.PyMongoError as e:
+        logger.error(f"Error saving product {tpnc}: {e}")
+        is_new_day = False
 
-    is_new_day = today_entry is None
-    if is_new_day:
-        today_entry = {"date": today_str, "normal": None, "discount": None, "clubcard": None}
-        history.append(today_entry)
+    return {category: is_new_day for category, _ in price_updates}
 
-    for category, fields in price_updates:
-        today_entry[category] = dict(fields)
 
-    if metadata:
-        data.update(metadata)
+class PriceWriteBuffer:
+    """Thread-safe buffer that writes daily price snapshots in bulk.
 
-    data["last_scraped_price"] = datetime.now().isoformat()
-    save_product_data(tpnc, data)
+    Scraper workers call add() instead of insert_daily_prices(); every
+    *batch_size* updates are sent as one unordered bulk_write of the same
+    upsert pipelines. Call flush() once the run ends to write the remainder
+    and collect the TPNCs whose writes failed.
+    """
 
-    return {category: is_new_day for category, _ in price_updates}
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self._pending = []  # (tpnc, UpdateOne)
+        self._failed = []
+        self._lock = threading.Lock()
+
+    def add(self, tpnc, price_updates, metadata=None):
+        tpnc = str(tpnc)
+        op = UpdateOne(
+            {"_id": tpnc},
+            _daily_prices_pipeline(tpnc, price_updates, metadata, datetime.now()),
+            upsert=True,
+        )
+        with self._lock:
+            self._pending.append((tpnc, op))
+            if len(self._pending) < self.batch_size:
+                return
+            pending, self._pending = self._pending, []
+        failed = self._write(pending)
+        if failed:
+            with self._lock:
+                self._failed.extend(failed)
+
+    def flush(self):
+        """Write any queued updates; return every TPNC whose write failed so far."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        failed = self._write(pending) if pending else []
+        with self._lock:
+            failed, self._failed = self._failed + failed, []
+        return failed
+
+    def _write(self, pending):
+        """bulk_write *pending* and return the TPNCs that were not stored."""
+        try:
+            get_db().bulk_write([op for _, op in pending], ordered=False)
+            return []
+        except mongo_errors.BulkWriteError as e:
+            failed = [pending[err["index"]][0] for err in e.details.get("writeErrors", [])]
+            logger.error(f"Bulk price write: {len(failed)} of {len(pending)} updates failed")
+            return failed
+        except mongo_errors.PyMongoError as e:
+            logger.error(f"Error writing {len(pending)} buffered price updates: {e}")
+            return [tpnc for tpnc, _ in pending]
 
 
 # ---------------------------------------------------------------------------
 # Query helpers (used by app.py / frontend)
 # ---------------------------------------------------------------------------
 
-def get_product(tpnc):
-    return load_product_data(tpnc)
+def get_product(tpnc, projection=None):
+    """Return the product document, optionally limited to *projection* fields."""
+    return load_product_data(tpnc, projection)
 
 
-def get_price_history(tpnc):
-    data = load_product_data(tpnc)
+def get_price_history_chrono(tpnc):
+    """Return the stored (oldest-first) price history, or None if the product is unknown."""
+    data = load_product_data(tpnc, {"price_history": 1})
     if not data:
-        return []
+        return None
     history = data.get("price_history", [])
-    if isinstance(history, dict):
+    if not isinstance(history, list):
         return []
+    return history
+
+
+def get_price_history(tpnc):
     # Return newest first
-    return list(reversed(history))
+    return list(reversed(get_price_history_chrono(tpnc) or []))
 
 
 def get_all_product_ids(skip=0, limit=100):
@@ -155,7 +273,7 @@ def get_product_stats(tpnc):
     -------
     dict or None if product not found.
     """
-    data = load_product_data(tpnc)
+    data = load_product_data(tpnc, {"name": 1, "price_history": 1})
     if not data:
         return None
 
@@ -196,6 +314,14 @@ def get_product_stats(tpnc):
     }
 
 
+# List/search queries read only the newest _RECENT_DAYS history entries, so they
+# don't transfer and decode the full history. _extract_price_details walks back to
+# the newest entry with a normal price, which is nearly always among them;
+# _recent_price_details re-reads the full history for the rare product where it isn't.
+_RECENT_DAYS = 7
+_RECENT_HISTORY = {"$slice": -_RECENT_DAYS}
+
+
 def _extract_price_details(doc: dict) -> dict:
     """Extract normal, discount, clubcard prices plus unit info from latest entry."""
     history = doc.get("price_history", [])
@@ -227,6 +353,20 @@ def _extract_price_details(doc: dict) -> dict:
     return result
 
 
+def _recent_price_details(doc: dict) -> dict:
+    """_extract_price_details for a *doc* read with the _RECENT_HISTORY slice.
+
+    Returns the same result as an unsliced read: if no recent entry has a normal
+    price and the slice may have cut older entries off, the full history is read.
+    """
+    info = _extract_price_details(doc)
+    history = doc.get("price_history")
+    if "last_scraped_price" in info or not isinstance(history, list) or len(history) < _RECENT_DAYS:
+        return info
+    full = load_product_data(doc.get("tpnc"), {"price_history": 1})
+    return _extract_price_details(full) if full else info
+
+
 def browse_products(skip=0, limit=100, sort_by="name", sort_dir="asc"):
     """Return lightweight product summaries for the catalogue view.
 
@@ -253,7 +393,7 @@ def browse_products(skip=0, limit=100, sort_by="name", sort_dir="asc"):
         "department_name": 1,
         "overall_rating": 1,
         "number_of_reviews": 1,
-        "price_history": 1,
+        "price_history": _RECENT_HISTORY,
     }
 
     # For name/price sorts MongoDB can do it natively (fast)
@@ -265,7 +405,7 @@ def browse_products(skip=0, limit=100, sort_by="name", sort_dir="asc"):
             tpnc = str(doc.get("tpnc") or doc.get("_id") or "")
             doc.pop("_id", None)
             doc["tpnc"] = tpnc
-            price_info = _extract_price_details(doc)
+            price_info = _recent_price_details(doc)
             doc.update(price_info)
             doc.pop("price_history", None)
             results.append(doc)
@@ -279,7 +419,7 @@ def browse_products(skip=0, limit=100, sort_by="name", sort_dir="asc"):
         tpnc = str(doc.get("tpnc") or doc.get("_id") or "")
         doc.pop("_id", None)
         doc["tpnc"] = tpnc
-        price_info = _extract_price_details(doc)
+        price_info = _recent_price_details(doc)
         doc.update(price_info)
         doc.pop("price_history", None)
         all_docs.append(doc)
@@ -302,6 +442,42 @@ def browse_products(skip=0, limit=100, sort_by="name", sort_dir="asc"):
     return {"results": all_docs[skip: skip + limit], "total": total, "skip": skip, "limit": limit}
 
 
+# ---------------------------------------------------------------------------
+# In-memory name index (substring fallback for search)
+# ---------------------------------------------------------------------------
+
+_NAME_INDEX_TTL = 300  # seconds
+_name_index: dict[str, str] = {}
+_name_index_built_at = 0.0
+_name_index_lock = threading.Lock()
+
+
+def _get_name_index() -> dict:
+    """Return {tpnc: lowercased name}, re-read from MongoDB at most every _NAME_INDEX_TTL seconds."""
+    global _name_index, _name_index_built_at
+    with _name_index_lock:
+        if not _name_index or time.monotonic() - _name_index_built_at > _NAME_INDEX_TTL:
+            coll = get_db()
+            _name_index = {
+                str(doc["_id"]): (doc.get("name") or "").lower()
+                for doc in coll.find({}, {"name": 1}).sort("_id", 1)
+            }
+            _name_index_built_at = time.monotonic()
+        return _name_index
+
+
+def _search_name_index(query: str, limit=None) -> list:
+    """Return TPNCs whose name or TPNC contains *query* (case-insensitive), in TPNC order."""
+    q = query.lower()
+    ids = []
+    for tpnc, name in _get_name_index().items():
+        if q in name or q in tpnc:
+            ids.append(tpnc)
+            if limit is not None and len(ids) >= limit:
+                break
+    return ids
+
+
 def search_products(query, skip: int = 0, limit: int = 50):
     results = []
     if not query:
@@ -313,15 +489,16 @@ def search_products(query, skip: int = 0, limit: int = 50):
     # Try text index search first
     text_cursor = coll.find(
         {"$text": {"$search": query}},
-        {"score": {"$meta": "textScore"}}
+        {"score": {"$meta": "textScore"}, "price_history": _RECENT_HISTORY}
     ).sort([("score", {"$meta": "textScore"})]).limit(SEARCH_MAX)
 
     results = list(text_cursor)
 
     if not results:
-        # Fallback to regex scan (handles Hungarian chars, TPNC, partial names)
-        regex_query = {"$regex": query, "$options": "i"}
-        results = list(coll.find({"$or": [{"name": regex_query}, {"_id": regex_query}]}).limit(SEARCH_MAX))
+        # Fallback to substring match (handles Hungarian chars, TPNC, partial names)
+        ids = _search_name_index(query, limit=SEARCH_MAX)
+        docs = {doc["_id"]: doc for doc in coll.find({"_id": {"$in": ids}}, {"price_history": _RECENT_HISTORY})}
+        results = [docs[i] for i in ids if i in docs]
 
     total = len(results)
     page_docs = results[skip: skip + limit]
@@ -332,7 +509,7 @@ def search_products(query, skip: int = 0, limit: int = 50):
         tpnc = str(doc.get("tpnc") or doc.get("_id") or "")
         doc["tpnc"] = tpnc
         doc.pop("_id", None)
-        price_info = _extract_price_details(doc)
+        price_info = _recent_price_details(doc)
         doc.update(price_info)
         doc.pop("price_history", None)
         doc.pop("score", None)
@@ -372,17 +549,18 @@ def search_products_with_category(
 
     text_cursor = coll.find(
         text_query,
-        {"score": {"$meta": "textScore"}},
+        {"score": {"$meta": "textScore"}, "price_history": _RECENT_HISTORY},
     ).sort([("score", {"$meta": "textScore"})]).limit(SEARCH_MAX)
 
     results = list(text_cursor)
 
     if not results:
-        # Fallback: regex scan (handles Hungarian chars, TPNC, partial names)
-        regex_q = {"$regex": query, "$options": "i"}
-        regex_filter: dict = {"$or": [{"name": regex_q}, {"_id": regex_q}, {"tpnc": regex_q}]}
-        combined: dict = {"$and": [regex_filter, cat_filter]} if cat_filter else regex_filter
-        results = list(coll.find(combined).limit(SEARCH_MAX))
+        # Fallback: substring match (handles Hungarian chars, TPNC, partial names)
+        # Without a category filter every match qualifies, so stop at SEARCH_MAX
+        ids = _search_name_index(query, limit=None if cat_filter else SEARCH_MAX)
+        results = list(coll.find(
+            {"_id": {"$in": ids}, **cat_filter}, {"price_history": _RECENT_HISTORY}
+        ).sort("_id", 1).limit(SEARCH_MAX))
 
     total = len(results)
     page_docs = results[skip: skip + limit]
@@ -392,7 +570,7 @@ def search_products_with_category(
         tpnc = str(doc.get("tpnc") or doc.get("_id") or "")
         doc["tpnc"] = tpnc
         doc.pop("_id", None)
-        price_info = _extract_price_details(doc)
+        price_info = _recent_price_details(doc)
         doc.update(price_info)
         doc.pop("price_history", None)
         doc.pop("score", None)
@@ -433,6 +611,42 @@ def set_cached_stat(key: str, data) -> None:
         logger.error(f"Error writing cache key {key}: {e}")
 
 
+# ---------------------------------------------------------------------------
+# Sitemap cache helpers
+# ---------------------------------------------------------------------------
+
+def get_sitemap_cache_collection():
+    get_db()
+    assert _db is not None
+    return _db['sitemap_cache']
+
+
+def get_sitemap_cache(url: str):
+    """Return the cached {etag, last_modified, product_ids} for a sitemap URL, or None."""
+    try:
+        return get_sitemap_cache_collection().find_one({"_id": url})
+    except mongo_errors.PyMongoError as e:
+        logger.error(f"Error reading sitemap cache for {url}: {e}")
+        return None
+
+
+def set_sitemap_cache(url: str, etag, last_modified, product_ids) -> None:
+    try:
+        get_sitemap_cache_collection().replace_one(
+            {"_id": url},
+            {
+                "_id": url,
+                "etag": etag,
+                "last_modified": last_modified,
+                "product_ids": list(product_ids),
+                "fetched_at": datetime.now().isoformat(),
+            },
+            upsert=True,
+        )
+    except mongo_errors.PyMongoError as e:
+        logger.error(f"Error writing sitemap cache for {url}: {e}")
+
+
 # ---------------------------------------------------------------------------
 # Run-state helpers (MongoDB-backed)
 # ---------------------------------------------------------------------------
@@ -456,6 +670,22 @@ def save_run_state(state: dict):
         logger.error(f"Failed to write run_state to mongo: {e}")
 
 
+def increment_run_state(state_id: str, processed: int = 0, errors=None):
+    """Add progress deltas to a saved run_state without rewriting the document.
+
+    *errors* maps tpnc -> number of new failures since the last call.
+    """
+    inc = {f"errors.{tpnc}": count for tpnc, count in (errors or {}).items()}
+    if processed:
+        inc["processed_count"] = processed
+    if not inc:
+        return
+    try:
+        get_runs_collection().update_one({"_id": state_id}, {"$inc": inc})
+    except mongo_errors.PyMongoError as e:
+        logger.error(f"Failed to update run_state in mongo: {e}")
+
+
 # ---------------------------------------------------------------------------
 # Price-drop discovery (used by the alert-service trigger)
 # ---------------------------------------------------------------------------
@@ -7,6 +7,7 @@ computation when the cache is cold).
 
 import math
 import logging
+import functools
 from collections import defaultdict
 from datetime import datetime, timedelta
 
@@ -64,6 +65,12 @@ def _latest_entry(history):
     return history[-1]
 
 
+@functools.lru_cache(maxsize=4096)
+def _weekday(date_str):
+    """Weekday index for a YYYY-MM-DD string; cached because every product repeats the same dates."""
+    return datetime.strptime(date_str, "%Y-%m-%d").weekday()
+
+
 def _entry_for_date(history, date_str):
     if isinstance(history, dict):
         return None
@@ -260,7 +267,7 @@ def compute_discount_by_weekday():
             if pct_off <= 0:
                 continue
             try:
-                wd = datetime.strptime(entry["date"], "%Y-%m-%d").weekday()
+                wd = _weekday(entry["date"])
                 weekday_pcts[wd].append(pct_off)
             except (ValueError, KeyError):
                 continue
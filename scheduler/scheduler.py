@@ -1,8 +1,7 @@
 import time
 import logging
-import pycron
-from datetime import datetime
-import pytz
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 from config import SCHEDULER_CRON, SCHEDULER_TIMEZONE, DEFAULT_THREADS
 from scraper.scraper import run_scraper, is_today_scrape_done
 from logging_setup import setup_logging, bind_correlation_id, clear_context
@@ -11,8 +10,23 @@ setup_logging()
 logger = logging.getLogger(__name__)
 
 
+_TZ = ZoneInfo(SCHEDULER_TIMEZONE)
+
+
 def now_in_tz():
-    return datetime.now(pytz.timezone(SCHEDULER_TIMEZONE))
+    return datetime.now(_TZ)
+
+
+def next_run_time(now):
+    """Next daily run after *now*, from the minute/hour fields of SCHEDULER_CRON.
+
+    Only fixed daily schedules (e.g. '0 5 * * *') are supported.
+    """
+    minute, hour = (int(field) for field in SCHEDULER_CRON.split()[:2])
+    target = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if target <= now:
+        target += timedelta(days=1)
+    return target
 
 
 def job():
@@ -43,11 +57,11 @@ if __name__ == "__main__":
     logger.info(f"Entering scheduler loop (cron: {SCHEDULER_CRON}, tz: {SCHEDULER_TIMEZONE}).")
 
     while True:
-        current_time = now_in_tz()
-        if pycron.is_now(SCHEDULER_CRON, dt=current_time):
-            if not is_today_scrape_done():
-                job()
-            else:
-                logger.info("Scheduled run skipped — today's scrape already completed.")
-            time.sleep(60)
-        time.sleep(20)
+        target = next_run_time(now_in_tz())
+        logger.info(f"Next scheduled run at {target.isoformat()}.")
+        # Compare epoch timestamps so a DST change in between doesn't skew the wait
+        time.sleep(max(0.0, target.timestamp() - time.time()))
+        if not is_today_scrape_done():
+            job()
+        else:
+            logger.info("Scheduled run skipped — today's scrape already completed.")
@@ -1,42 +1,88 @@
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
 import re
 import time
 import random
 import os
 import logging
+import math
 import argparse
 import concurrent.futures
+import itertools
+import signal
 import threading
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 from lxml import etree  # type: ignore[import-untyped]
-from config import API_URL, HEADERS, SITEMAP_INDEX_URL, DEFAULT_THREADS
+from config import API_URL, HEADERS, SITEMAP_INDEX_URL, DEFAULT_THREADS, API_BATCH_SIZE
 from mongo.queries import FULL_PRODUCT_QUERY, PRICE_ONLY_QUERY
 from mongo import database_manager as db
 from mongo import stats_manager
+from mongo.products_catalog_manager import upsert_product_catalog
 
 # NOTE: structured logging is configured at the entrypoint that imports
 # this module (scheduler.py calls setup_logging()). Don't call basicConfig
 # here or it'll add a second handler that emits plain-text lines.
 logger = logging.getLogger(__name__)
 
+# One pooled session for all Tesco calls so worker threads reuse keep-alive
+# connections instead of doing a TCP+TLS handshake per request. Headers stay
+# per-call: the sitemap host must not receive the API key.
+SESSION = requests.Session()
+
+# Sitemaps are static files on the shop host, not the rate-limited API, so
+# they're fetched with their own pool instead of the --threads setting.
+SITEMAP_WORKERS = 8
+
+
+def _size_session_pool(threads):
+    """(Re)mount the HTTPS adapter with room for *threads* concurrent connections per host.
+
+    The pool is never smaller than SITEMAP_WORKERS, since sitemaps share the session.
+    """
+    old = SESSION.adapters.get('https://')
+    pool_maxsize = max(threads * 4, SITEMAP_WORKERS)
+    SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=0))
+    if old is not None:
+        old.close()
+
+
+_size_session_pool(DEFAULT_THREADS)
+
+RUN_STATE_SAVE_EVERY = 100        # items
+RUN_STATE_SAVE_INTERVAL = 5.0     # seconds
+
+# Set by Ctrl-C during run_scraper: workers stop before their next API call or
+# retry sleep, so buffered writes and run-state are saved before exiting.
+STOP = threading.Event()
+
 
 # ---------------------------------------------------------------------------
 # Skip-check: reads from MongoDB, no local file fallback.
 # ---------------------------------------------------------------------------
 
+def _is_stale(last_scraped, today_iso=None):
+    """Return True if the *last_scraped* ISO timestamp is missing or before today.
+
+    ISO dates sort lexically, so the YYYY-MM-DD prefix is compared as a string
+    instead of parsing a datetime per product. Pass *today_iso* when checking
+    many products at once.
+    """
+    if not isinstance(last_scraped, str) or len(last_scraped) < 10:
+        return True
+    if today_iso is None:
+        today_iso = datetime.now().date().isoformat()
+    return last_scraped[:10] < today_iso
+
+
 def needs_scraping(tpnc):
     """Return True if *tpnc* has not been scraped today (calendar-day check)."""
-    prod = db.get_product(tpnc)
+    prod = db.get_product(tpnc, projection={"last_scraped_price": 1})
     if not prod:
         return True
-    last_scraped = prod.get('last_scraped_price')
-    if not last_scraped:
-        return True
-    try:
-        last_date = datetime.fromisoformat(last_scraped).date()
-        return last_date < datetime.now().date()
-    except (ValueError, AttributeError):
-        return True
+    return _is_stale(prod.get('last_scraped_price'))
 
 
 def is_today_scrape_done():
@@ -52,101 +98,304 @@ def is_today_scrape_done():
 # Sitemap fetching
 # ---------------------------------------------------------------------------
 
+SITEMAP_NS = '{http://www.sitemaps.org/schemas/sitemap/0.9}'
+SITEMAP_LOC_TAG = SITEMAP_NS + 'loc'
+PRODUCT_ID_RE = re.compile(r'/products/(\d+)')
+# Applied to promotion descriptions with spaces / NBSPs already stripped
+PROMO_PRICE_RE = re.compile(r'(\d+)Ft', re.IGNORECASE)
+_PROMO_WS_TABLE = str.maketrans('', '', '\xa0 ')
+
 def fetch_sitemap_index(url):
     try:
-        response = requests.get(url, headers={'User-Agent': HEADERS['User-Agent']}, timeout=30)
-        response.raise_for_status()
-        root = etree.fromstring(response.content)
-        namespaces = {'ns': 'http://www.sitemaps.org/schemas/sitemap/0.9'}
-        locs = root.xpath('//ns:loc', namespaces=namespaces)
-        return [loc.text for loc in locs]
-    except (requests.RequestException, etree.XMLSyntaxError, OSError) as e:
+        with SESSION.get(url, headers={'User-Agent': HEADERS['User-Agent']}, timeout=30,
+                         stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            return [loc for loc in _iter_sitemap_locs(response.raw) if loc]
+    except (requests.RequestException, Urllib3HTTPError, etree.XMLSyntaxError, OSError) as e:
         logger.error(f"Error fetching sitemap index: {e}")
         return []
 
 
+def _iter_sitemap_locs(stream):
+    """Yield <loc> texts from a sitemap stream without building the whole tree."""
+    for _, elem in etree.iterparse(stream, tag=SITEMAP_LOC_TAG):
+        yield elem.text or ''
+        # Drop the finished <loc> and its already-processed siblings to keep memory flat
+        elem.clear()
+        entry = elem.getparent()
+        while entry is not None and entry.getprevious() is not None:
+            del entry.getparent()[0]
+
+
 def fetch_product_urls_from_sitemap(url):
+    """Return the product IDs listed in a sitemap.
+
+    The sitemap's ETag/Last-Modified are stored alongside its IDs, and sent
+    back as conditional headers next time; on 304 Not Modified the stored IDs
+    are returned without downloading or parsing the body.
+    """
+    cached = db.get_sitemap_cache(url)
+    headers = {'User-Agent': HEADERS['User-Agent']}
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
     try:
-        response = requests.get(url, headers={'User-Agent': HEADERS['User-Agent']}, timeout=30)
-        response.raise_for_status()
-        root = etree.fromstring(response.content)
-        namespaces = {'ns': 'http://www.sitemaps.org/schemas/sitemap/0.9'}
-        locs = root.xpath('//ns:loc', namespaces=namespaces)
-        product_ids = []
-        for loc in locs:
-            match = re.search(r'/products/(\d+)', loc.text)
-            if match:
-                product_ids.append(match.group(1))
-        return product_ids
-    except (requests.RequestException, etree.XMLSyntaxError, OSError) as e:
+        with SESSION.get(url, headers=headers, timeout=30, stream=True) as response:
+            if response.status_code == 304 and cached:
+                logger.debug(f"Sitemap unchanged, using cached IDs: {url}")
+                return cached.get('product_ids', [])
+            response.raise_for_status()
+            response.raw.decode_content = True
+            product_ids = [
+                match.group(1)
+                for match in map(PRODUCT_ID_RE.search, _iter_sitemap_locs(response.raw))
+                if match
+            ]
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+    except (requests.RequestException, Urllib3HTTPError, etree.XMLSyntaxError, OSError) as e:
         logger.error(f"Error fetching sitemap {url}: {e}")
         return []
 
+    if etag or last_modified:
+        db.set_sitemap_cache(url, etag, last_modified, product_ids)
+    return product_ids
+
 
 # ---------------------------------------------------------------------------
 # Tesco GraphQL API call with exponential backoff
 # ---------------------------------------------------------------------------
 
-def get_product_api(tpnc, query_type="full"):
-    if query_type == "full":
-        query = FULL_PRODUCT_QUERY
-        operation_name = "GetProduct"
-    else:
-        query = PRICE_ONLY_QUERY
-        operation_name = "GetProductPrice"
+# GraphQL ignores insignificant whitespace: collapse the readable query text once
+# so each operation in a batched POST doesn't resend the indentation.
+_QUERIES = {
+    "full": ("GetProduct", " ".join(FULL_PRODUCT_QUERY.split())),
+    "price": ("GetProductPrice", " ".join(PRICE_ONLY_QUERY.split())),
+}
+
+
+class RateLimitedError(requests.RequestException):
+    """HTTP 429 from the Tesco API; *retry_after* is the server-requested wait in seconds, if sent."""
+
+    def __init__(self, retry_after=None):
+        super().__init__("Rate Limited (429)")
+        self.retry_after = retry_after
+
+
+# Upper bound on a server-requested wait, so one bad header can't stall every worker
+MAX_RETRY_AFTER = 120.0  # seconds
+
+
+def _parse_retry_after(value):
+    """Return the Retry-After header as seconds (delta-seconds or HTTP-date form), or None.
+
+    Non-finite values are rejected and the result is clamped to MAX_RETRY_AFTER.
+    """
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    if not math.isfinite(seconds):
+        return None
+    return min(max(0.0, seconds), MAX_RETRY_AFTER)
+
+
+# Shared cooldown: after a 429 on any worker, every worker holds off new requests
+# until this monotonic deadline instead of each one hammering the API on its own.
+_cooldown_lock = threading.Lock()
+_cooldown_until = 0.0
+
+
+def _start_cooldown(seconds):
+    global _cooldown_until
+    with _cooldown_lock:
+        _cooldown_until = max(_cooldown_until, time.monotonic() + seconds)
+
+
+def _wait_for_cooldown():
+    """Sleep out any shared cooldown. Returns True if STOP was set meanwhile."""
+    remaining = _cooldown_until - time.monotonic()
+    if remaining > 0:
+        return STOP.wait(remaining)
+    return STOP.is_set()
+
+
+def _is_retryable(exc):
+    """Return True for transient failures: network errors, 5xx, 408/425/429."""
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        status = exc.response.status_code
+        return status >= 500 or status in (408, 425, 429)
+    return True
+
+
+def _match_responses(tpncs, response_json, label):
+    """Map each batched GraphQL response to its TPNC via data.product.id.
+
+    Position in the batch is only trusted for responses without a product id,
+    and only when the API returned exactly one response per TPNC.
+    """
+    results = dict.fromkeys(tpncs)
+    by_id = {str(tpnc): tpnc for tpnc in tpncs}
+    positional = len(response_json) == len(tpncs)
+    if not positional:
+        logger.warning(f"API returned {len(response_json)} responses for {len(tpncs)} products "
+                       f"({label}); matching by product id only.")
+
+    unkeyed = []
+    for pos, item in enumerate(response_json):
+        product = ((item.get('data') or {}).get('product') or {}) if isinstance(item, dict) else {}
+        product_id = product.get('id')
+        if product_id is None:
+            unkeyed.append(pos)
+        elif str(product_id) in by_id:
+            results[by_id[str(product_id)]] = item
+        else:
+            logger.warning(f"API returned unrequested product {product_id} ({label}); dropped.")
+
+    if positional:
+        for pos in unkeyed:
+            if results[tpncs[pos]] is None:
+                results[tpncs[pos]] = response_json[pos]
+    return results
+
+
+def get_products_api(tpncs, query_type="full"):
+    """Fetch several products in a single POST (one GraphQL operation per TPNC).
+
+    Returns {tpnc: response}, matched by data.product.id; values are None
+    when the API gave no result.
+    """
+    operation_name, query = _QUERIES["full" if query_type == "full" else "price"]
 
     payload = [{
         "operationName": operation_name,
         "variables": {"tpnc": str(tpnc)},
         "extensions": {"mfeName": "mfe-pdp"},
         "query": query,
-    }]
+    } for tpnc in tpncs]
+    # Serialized once, reused across retries (HEADERS already sets content-type)
+    body = orjson.dumps(payload)
+    label = tpncs[0] if len(tpncs) == 1 else f"{tpncs[0]} (+{len(tpncs) - 1} more)"
 
     max_retries = 5
     base_delay = 2
 
     for attempt in range(max_retries):
+        if STOP.is_set():
+            return dict.fromkeys(tpncs)
         try:
-            response = requests.post(API_URL, headers=HEADERS, json=payload, timeout=30)
+            if _wait_for_cooldown():
+                return dict.fromkeys(tpncs)
+            response = SESSION.post(API_URL, headers=HEADERS, data=body, timeout=30)
             if response.status_code == 429:
-                raise requests.RequestException("Rate Limited (429)")
+                raise RateLimitedError(_parse_retry_after(response.headers.get('Retry-After')))
             response.raise_for_status()
-            response_json = response.json()
-            if isinstance(response_json, list) and len(response_json) > 0:
-                return response_json[0]
-            return None
-        except (requests.RequestException, ValueError) as e:
+            response_json = orjson.loads(response.content)
+            if isinstance(response_json, list):
+                return _match_responses(tpncs, response_json, label)
+            return dict.fromkeys(tpncs)
+        except ValueError as e:
+            # Malformed JSON won't fix itself on retry
+            logger.error(f"Invalid API response for {label}: {e}")
+            return dict.fromkeys(tpncs)
+        except requests.RequestException as e:
+            if not _is_retryable(e):
+                logger.error(f"API request failed for {label} (not retryable): {e}")
+                return dict.fromkeys(tpncs)
             if attempt < max_retries - 1:
-                sleep_time = base_delay * (2 ** attempt) + random.uniform(0, 1)
+                if isinstance(e, RateLimitedError) and e.retry_after is not None:
+                    sleep_time = e.retry_after + random.uniform(0, 1)
+                else:
+                    sleep_time = base_delay * (2 ** attempt) + random.uniform(0, 1)
                 if "Max retries exceeded" in str(e):
                     sleep_time = 3
-                logger.warning(f"API request failed for {tpnc} (Attempt {attempt+1}/{max_retries}). "
+                if isinstance(e, RateLimitedError):
+                    _start_cooldown(sleep_time)
+                logger.warning(f"API request failed for {label} (Attempt {attempt+1}/{max_retries}). "
                                f"Retrying in {sleep_time:.2f}s. Error: {e}")
-                time.sleep(sleep_time)
+                if STOP.wait(sleep_time):
+                    return dict.fromkeys(tpncs)
             else:
-                logger.error(f"API request failed for {tpnc} after {max_retries} attempts: {e}")
+                logger.error(f"API request failed for {label} after {max_retries} attempts: {e}")
                 if "Max retries exceeded" in str(e):
                     time.sleep(3)
-                return None
+                return dict.fromkeys(tpncs)
 
 
 # ---------------------------------------------------------------------------
-# Process a single product
+# Process products
 # ---------------------------------------------------------------------------
 
+def process_products(items, force=False, buffer=None, scrape_state=None):
+    """Fetch and store a batch of products, one API request per query type.
+
+    *items* is a list of (tpnc, progress_prefix) tuples. If *buffer* (a
+    db.PriceWriteBuffer) is given, prices are queued on it instead of written
+    one product at a time. *scrape_state* ({tpnc: last_scraped_price}, as from
+    db.bulk_fetch_scrape_state) replaces the per-item existence/freshness reads.
+    Returns {tpnc: bool} — True if the product was processed (API called), False if skipped/failed.
+    """
+    results = {}
+    if STOP.is_set():
+        return results
+    pending = {"full": [], "price": []}
+    for tpnc, progress_prefix in items:
+        # A stale product gets a new history entry for today when stored
+        if scrape_state is not None:
+            exists = tpnc in scrape_state
+            new_day = not exists or _is_stale(scrape_state[tpnc])
+        else:
+            exists = db.product_exists(tpnc)
+            new_day = not exists or needs_scraping(tpnc)
+        if not force and not new_day:
+            logger.debug(f"{progress_prefix}Skipping {tpnc}: already up-to-date.")
+            results[tpnc] = False
+            continue
+        pending["price" if exists else "full"].append((tpnc, progress_prefix, new_day))
+
+    for query_type, group in pending.items():
+        if not group or STOP.is_set():
+            continue
+        responses = get_products_api([tpnc for tpnc, _, _ in group], query_type)
+        if STOP.is_set() and not any(responses.values()):
+            break
+        for tpnc, progress_prefix, new_day in group:
+            data = responses.get(tpnc)
+            try:
+                results[tpnc] = _store_product(tpnc, data, query_type, progress_prefix, new_day, buffer)
+            except Exception as e:
+                logger.exception(f"Unhandled error processing {tpnc}: {e}")
+                results[tpnc] = False
+    return results
+
+
 def process_product(tpnc, force=False, progress_prefix=""):
     """Fetch data for *tpnc* and store prices in all applicable categories.
 
     Returns True if the product was processed (API called), False if skipped/failed.
     """
-    exists = db.product_exists(tpnc)
+    return process_products([(tpnc, progress_prefix)], force=force).get(tpnc, False)
+
+
+def _promo_desc_price(promo_desc):
+    """Return the Forint price written in a promotion description ("1 299 Ft"), or None."""
+    if not promo_desc:
+        return None
+    match = PROMO_PRICE_RE.search(promo_desc.translate(_PROMO_WS_TABLE))
+    return int(match.group(1)) if match else None
 
-    if exists and not force and not needs_scraping(tpnc):
-        logger.debug(f"{progress_prefix}Skipping {tpnc}: already up-to-date.")
-        return False
 
-    query_type = "price" if exists else "full"
-    data = get_product_api(tpnc, query_type)
+def _store_product(tpnc, data, query_type, progress_prefix="", new_day=True, buffer=None):
+    """Store one product's API response. Returns True if prices were saved (or queued)."""
     if not data or 'data' not in data or not data['data']['product']:
         logger.warning(f"{progress_prefix}No data returned for {tpnc}. Response: {data}")
         return False
@@ -169,45 +418,37 @@ def process_product(tpnc, force=False, progress_prefix=""):
         "unit_measure": unit_measure,
     })]
 
+    # Single pass: only the last Clubcard promotion and the last real discount
+    # are kept (later entries for a category overwrite earlier ones on save).
+    clubcard_promo = None
+    discount = None
     for promo in promotions:
-        promo_id = promo.get('id')
-        promo_desc = promo.get('description')
-        promo_start = promo.get('startDate')
-        promo_end = promo.get('endDate')
-        attributes = promo.get('attributes') or []
-        promo_price = None
-        if promo.get('price'):
-            promo_price = promo['price'].get('afterDiscount')
-
-        if "CLUBCARD_PRICING" in attributes:
-            cc_price = promo_price
-            if promo_desc:
-                clean_desc = promo_desc.replace('\xa0', '').replace(' ', '')
-                match = re.search(r'(\d+)Ft', clean_desc, re.IGNORECASE)
-                if match:
-                    parsed_price = float(match.group(1))
-                    if cc_price is None or cc_price == price_actual:
-                        cc_price = parsed_price
-            price_updates.append(("clubcard", {
-                "price": cc_price,
-                "unit_price": unit_price,
-                "unit_measure": unit_measure,
-                "promo_id": promo_id,
-                "promo_desc": promo_desc,
-                "promo_start": promo_start,
-                "promo_end": promo_end,
-            }))
-        else:
-            if promo_price and promo_price != price_actual:
-                price_updates.append(("discount", {
-                    "price": promo_price,
-                    "unit_price": unit_price,
-                    "unit_measure": unit_measure,
-                    "promo_id": promo_id,
-                    "promo_desc": promo_desc,
-                    "promo_start": promo_start,
-                    "promo_end": promo_end,
-                }))
+        promo_price = (promo.get('price') or {}).get('afterDiscount')
+        if "CLUBCARD_PRICING" in (promo.get('attributes') or ()):
+            clubcard_promo = (promo, promo_price)
+        elif promo_price and promo_price != price_actual:
+            discount = (promo, promo_price)
+
+    def _promo_fields(promo, price):
+        return {
+            "price": price,
+            "unit_price": unit_price,
+            "unit_measure": unit_measure,
+            "promo_id": promo.get('id'),
+            "promo_desc": promo.get('description'),
+            "promo_start": promo.get('startDate'),
+            "promo_end": promo.get('endDate'),
+        }
+
+    if clubcard_promo:
+        promo, cc_price = clubcard_promo
+        parsed_price = _promo_desc_price(promo.get('description'))
+        if parsed_price is not None and (cc_price is None or cc_price == price_actual):
+            cc_price = parsed_price
+        price_updates.append(("clubcard", _promo_fields(promo, cc_price)))
+
+    if discount:
+        price_updates.append(("discount", _promo_fields(*discount)))
 
     # ---- Build metadata dict on first fetch ----
     metadata = None
@@ -341,11 +582,14 @@ def process_product(tpnc, force=False, progress_prefix=""):
         metadata = {k: v for k, v in metadata.items() if not _is_empty(v)}
 
     # ---- Single load/save for all categories + optional metadata ----
-    results = db.insert_daily_prices(tpnc, price_updates, metadata=metadata)
+    if buffer is not None:
+        buffer.add(tpnc, price_updates, metadata=metadata)
+        changed = new_day
+    else:
+        changed = any(db.insert_daily_prices(tpnc, price_updates, metadata=metadata).values())
 
     if metadata:
         try:
-            from mongo.products_catalog_manager import upsert_product_catalog
             catalog_meta = dict(metadata)
             catalog_meta["tpnc"] = str(tpnc)
             upsert_product_catalog(catalog_meta)
@@ -353,7 +597,7 @@ def process_product(tpnc, force=False, progress_prefix=""):
             logger.warning("Catalog upsert failed for %s (non-fatal)", tpnc, exc_info=True)
 
     # ---- Logging ----
-    change_status = "Changed" if any(results.values()) else "Unchanged"
+    change_status = "Changed" if changed else "Unchanged"
     log_prices = [f"Normal: {price_actual}"]
     for category, fields in price_updates:
         if category == "discount":
@@ -369,14 +613,17 @@ def process_product(tpnc, force=False, progress_prefix=""):
 # Main scraper entry point
 # ---------------------------------------------------------------------------
 
-def run_scraper(specific_items=None, force=False, threads=DEFAULT_THREADS):
+def run_scraper(specific_items=None, force=False, threads=DEFAULT_THREADS, batch_size=API_BATCH_SIZE):
     """Run the scraper.
 
     - specific_items provided: always scrapes those items (no skip check).
     - No specific_items: skips products already scraped today (calendar-day).
     - force=True: scrapes everything regardless.
+    - batch_size: products sent per API request.
     """
     db.init_db()
+    if threads != DEFAULT_THREADS:
+        _size_session_pool(threads)
 
     # ---- Build product ID list ----
     if specific_items:
@@ -385,50 +632,58 @@ def run_scraper(specific_items=None, force=False, threads=DEFAULT_THREADS):
     else:
         sitemaps = fetch_sitemap_index(SITEMAP_INDEX_URL)
         logger.info(f"Found {len(sitemaps)} sitemaps.")
-        all_product_ids = []
-        for sitemap_url in sitemaps:
-            time.sleep(0.5)
-            logger.info(f"Fetching products from sitemap: {sitemap_url}")
-            ids = fetch_product_urls_from_sitemap(sitemap_url)
-            logger.info(f"Found {len(ids)} products in {sitemap_url}")
-            all_product_ids.extend(ids)
-        # Deduplicate
-        all_items = list(dict.fromkeys(all_product_ids))
+        # Deduplicate as we go; order doesn't matter since the list is sorted below
+        all_product_ids = set()
+        sitemap_workers = max(1, min(SITEMAP_WORKERS, len(sitemaps)))
+        logger.info(f"Fetching products from {len(sitemaps)} sitemaps with {sitemap_workers} threads...")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=sitemap_workers) as sitemap_pool:
+            sitemap_futures = {
+                sitemap_pool.submit(fetch_product_urls_from_sitemap, sitemap_url): sitemap_url
+                for sitemap_url in sitemaps
+            }
+            for future in concurrent.futures.as_completed(sitemap_futures):
+                ids = future.result()
+                logger.info(f"Found {len(ids)} products in {sitemap_futures[future]}")
+                all_product_ids.update(ids)
+        all_items = list(all_product_ids)
         logger.info(f"Total unique products discovered: {len(all_items)}")
 
     # ---- Sort by ascending numeric ID (lowest first) ----
     all_items.sort(key=lambda x: int(x))
 
-    # ---- Filter: check each product in parallel ----
+    # ---- Filter: one bulk read of every product's last scrape time ----
     # specific_items runs always; full runs skip products already done today.
+    # Workers reuse the same snapshot instead of re-reading each product.
+    logger.info("Reading scrape state for all products (bulk DB read)...")
+    scrape_state = db.bulk_fetch_scrape_state(all_items)
     if force or specific_items:
         items_to_process = list(all_items)
     else:
-        logger.info("Checking which products need scraping (parallel DB reads)...")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as check_pool:
-            check_results = list(check_pool.map(
-                lambda tpnc: (tpnc, needs_scraping(tpnc)), all_items
-            ))
-        items_to_process = [tpnc for tpnc, needed in check_results if needed]
+        today_iso = datetime.now().date().isoformat()
+        items_to_process = [tpnc for tpnc in all_items
+                            if _is_stale(scrape_state.get(tpnc), today_iso)]
 
     logger.info(f"{len(items_to_process)} items to process (out of {len(all_items)} total).")
 
+    now = datetime.now()
+    now_str = now.isoformat()
+
     if not items_to_process:
         logger.info("All products are up-to-date. Nothing to do.")
         db.save_run_state({
-            'date': datetime.now().date().isoformat(),
+            'date': now.date().isoformat(),
             'total_items': len(all_items),
             'processed_count': len(all_items),
             'completed': True,
-            'finished_at': datetime.now().isoformat(),
+            'finished_at': now_str,
         })
         return
 
     # ---- Initialize advisory run-state ----
     state = {
-        'date': datetime.now().date().isoformat(),
-        'run_id': datetime.now().isoformat(),
-        'started_at': datetime.now().isoformat(),
+        'date': now.date().isoformat(),
+        'run_id': now_str,
+        'started_at': now_str,
         'total_items': len(all_items),
         'processed_count': len(all_items) - len(items_to_process),
         'errors': {},
@@ -438,43 +693,104 @@ def run_scraper(specific_items=None, force=False, threads=DEFAULT_THREADS):
 
     # ---- Process items with thread pool ----
     lock = threading.Lock()
+    price_buffer = db.PriceWriteBuffer()
     total = len(all_items)
     # Pre-build index to avoid O(n²) .index() calls inside the loop
     item_index = {tpnc: i + 1 for i, tpnc in enumerate(all_items)}
 
-    def _task_wrapper(idx, tpnc):
-        success = False
+    # Run-state is advisory: persist it every RUN_STATE_SAVE_EVERY items or
+    # RUN_STATE_SAVE_INTERVAL seconds rather than after each batch, sending
+    # only the progress made since the last save ($inc, not a full rewrite).
+    unsaved = 0
+    last_save = time.monotonic()
+    unsaved_done = 0
+    unsaved_errors = {}
+
+    def _task_wrapper(batch):
+        nonlocal unsaved, last_save, unsaved_done, unsaved_errors
+        results = {}
         try:
-            success = process_product(tpnc, force=force,
-                                      progress_prefix=f"[{idx}/{total}] ")
+            results = process_products(
+                [(tpnc, f"[{idx}/{total}] ") for idx, tpnc in batch],
+                force=force, buffer=price_buffer, scrape_state=scrape_state,
+            )
         except Exception as e:
-            logger.exception(f"Unhandled error processing {tpnc}: {e}")
+            logger.exception(f"Unhandled error processing batch starting at {batch[0][1]}: {e}")
+
+        # Products skipped as already fresh (per the run's snapshot) count as done
+        done, failed = 0, []
+        for _, tpnc in batch:
+            if tpnc not in results and STOP.is_set():
+                continue  # never attempted: stays pending for the next run
+            if results.get(tpnc) or not _is_stale(scrape_state.get(tpnc)):
+                done += 1
+            else:
+                failed.append(tpnc)
 
         with lock:
-            if success or not needs_scraping(tpnc):
-                state['processed_count'] = state.get('processed_count', 0) + 1
-            else:
-                state.setdefault('errors', {})[tpnc] = \
-                    state.get('errors', {}).get(tpnc, 0) + 1
+            state['processed_count'] = state.get('processed_count', 0) + done
+            errors = state.setdefault('errors', {})
+            for tpnc in failed:
+                errors[tpnc] = errors.get(tpnc, 0) + 1
+                unsaved_errors[tpnc] = unsaved_errors.get(tpnc, 0) + 1
+            unsaved_done += done
+            unsaved += len(batch)
+            if unsaved < RUN_STATE_SAVE_EVERY and time.monotonic() - last_save < RUN_STATE_SAVE_INTERVAL:
+                return
+            delta_done, delta_errors = unsaved_done, unsaved_errors
+            unsaved, unsaved_done, unsaved_errors = 0, 0, {}
+            last_save = time.monotonic()
         # DB write outside the lock to avoid blocking other threads during I/O
-        db.save_run_state(state)
+        db.increment_run_state(state['date'], processed=delta_done, errors=delta_errors)
 
     executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
-    futures = []
+    # Bounded submission: only a few batches per worker are queued at a time,
+    # so memory doesn't grow with the catalogue and the main thread just blocks
+    # until a slot frees up.
+    max_outstanding = threads * 4
+    outstanding = set()
+    # Ctrl-C sets STOP instead of raising mid-write; in-flight requests are
+    # allowed to finish. Signal handlers can only be installed from the main thread.
+    STOP.clear()
+    previous_sigint = None
+    if threading.current_thread() is threading.main_thread():
+        previous_sigint = signal.signal(signal.SIGINT, _request_stop)
     try:
-        for tpnc in items_to_process:
-            idx = item_index[tpnc]
-            futures.append(executor.submit(_task_wrapper, idx, tpnc))
-
-        _, not_done = concurrent.futures.wait(futures, timeout=1.0)
-        while not_done:
-            _, not_done = concurrent.futures.wait(futures, timeout=1.0)
+        # Group items so each worker sends one API request per batch
+        indexed_items = ((item_index[tpnc], tpnc) for tpnc in items_to_process)
+        while batch := list(itertools.islice(indexed_items, batch_size)):
+            if STOP.is_set():
+                break
+            if len(outstanding) >= max_outstanding:
+                _, outstanding = concurrent.futures.wait(
+                    outstanding, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+            outstanding.add(executor.submit(_task_wrapper, batch))
+
+        concurrent.futures.wait(outstanding)
 
-    except KeyboardInterrupt:
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        failed_writes = price_buffer.flush()
+        if previous_sigint is not None:
+            signal.signal(signal.SIGINT, previous_sigint)
+        # Reset so later calls in this process (e.g. process_product) aren't stopped
+        interrupted = STOP.is_set()
+        STOP.clear()
+
+    # Buffered prices that never reached Mongo were counted as done by their
+    # worker; move them back to errors so the run ends partial and resumes.
+    if failed_writes:
+        logger.error(f"{len(failed_writes)} products' prices failed to save.")
+        state['processed_count'] = state.get('processed_count', 0) - len(failed_writes)
+        errors = state.setdefault('errors', {})
+        for tpnc in failed_writes:
+            errors[tpnc] = errors.get(tpnc, 0) + 1
+
+    if interrupted:
+        db.save_run_state(state)
         logger.warning("Scraping interrupted — progress saved.")
         return
-    finally:
-        executor.shutdown(wait=True)
 
     # ---- Finalize run-state ----
     processed = state.get('processed_count', 0)
@@ -491,6 +807,13 @@ def run_scraper(specific_items=None, force=False, threads=DEFAULT_THREADS):
         logger.info(f"Daily scrape partial: {processed}/{len(all_items)} items — will resume on next run.")
 
 
+def _request_stop(signum, frame):
+    """SIGINT handler for run_scraper: ask workers to stop after their current request."""
+    if not STOP.is_set():
+        logger.warning("Stop requested — finishing in-flight requests and saving progress...")
+    STOP.set()
+
+
 def _notify_alert_service():
     """Notify the alert-service of today's price drops.
 
@@ -539,5 +862,8 @@ if __name__ == "__main__":
     parser.add_argument('--force', action='store_true', help='Force rescrape')
     parser.add_argument('--threads', type=int, default=DEFAULT_THREADS,
                         help=f'Concurrent threads (default: {DEFAULT_THREADS})')
+    parser.add_argument('--batch-size', type=int, default=API_BATCH_SIZE,
+                        help=f'Products per API request (default: {API_BATCH_SIZE})')
     args = parser.parse_args()
-    run_scraper(specific_items=args.items, force=args.force, threads=args.threads)
+    run_scraper(specific_items=args.items, force=args.force, threads=args.threads,
+                batch_size=max(1, args.batch_size))